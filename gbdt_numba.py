@@ -1,85 +1,479 @@
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
 import numpy as np
-from numba import jit
+import numba
+from numba import njit, prange
+try:
+    from numba import cuda
+except ImportError:
+    cuda=None
 
-@jit
-def leaf_score(g,h,reg_lambda):
+# Trees of at most this depth are laid out as a binary heap, deeper trees get compact ids.
+_HEAP_MAX_DEPTH=6
+# The most memory the histograms of a tree may take, which bounds the number of histogram slots.
+_HIST_POOL_BYTES=128*2**20
+
+@njit('float64(float64,float64,float64)',fastmath=True,boundscheck=False,cache=True)
+def leaf_score(G,H,reg_lambda):
     '''
-    Given the gradient and hessian of a tree leaf,
+    Given the sum of gradient G and the sum of hessian H of a tree leaf,
     return the prediction (score) at this leaf.
     The score is -G/(H+λ).
     '''
-    return -np.sum(g)/(np.sum(h)+reg_lambda)
+    return -G/(H+reg_lambda)
 
-@jit
-def leaf_loss(g,h,reg_lambda):
+def _bin_features(train,max_bin=256):
     '''
-    Given the gradient and hessian of a tree leaf,
-    return the minimized loss at this leaf.
-    The minimized loss is -0.5*G^2/(H+λ).
+    Bin each feature once into at most max_bin bins, so that split finding
+    only needs a histogram over the bins instead of sorting the raw values.
+    If a feature takes no more than max_bin distinct values,
+    the bin edges are the midpoints between consecutive values,
+    otherwise the bin edges are taken at the quantiles of the feature,
+    each moved to the midpoint between the distinct value at or below the quantile and the next one.
+    The midpoints are computed in float64 and rounded to the dtype of train,
+    and a midpoint that rounds down onto the lower value is replaced by the higher one,
+    so every edge e between consecutive distinct values a<b satisfies a<e<=b.
+    Thus x<e still separates a from b,
+    and a heavily repeated value, which may be a quantile itself, still gets a bin of its own.
+    train is transposed once, so that each feature is read as a contiguous row.
+    Each feature is sorted only once, and the sorted values are used
+    both to find the distinct values and to compute the quantiles.
+    A value x falls into bin b, where b is the number of edges not greater than x,
+    thus x<edges[b] holds if and only if x falls into bin b or a lower bin.
+    The bins are the only split candidates, so max_bin bounds the cost of the split search,
+    and a few hundred quantiles are enough to find a split close to the exact one.
+    Return the binned features as a uint8 array of shape (n_features,n_samples),
+    together with the list of bin edges, which have the same dtype as train.
     '''
-    return -0.5*np.square(np.sum(g))/(np.sum(h)+reg_lambda)
+    if not 2<=max_bin<=256:
+        raise ValueError('max_bin should be between 2 and 256.')
+    train_T=np.ascontiguousarray(train.T)
+    X_binned=np.empty(train_T.shape,dtype=np.uint8)
+    bin_edges=[]
+    for j in range(len(train_T)):
+        col=np.sort(train_T[j])
+        unq=col[np.concatenate(([True],col[1:]!=col[:-1]))]
+        if len(unq)<=max_bin:
+            lower=unq[:-1]
+            upper=unq[1:]
+        else:
+            q=np.quantile(col,np.linspace(0,1,max_bin+1)[1:-1])
+            k=np.minimum(np.searchsorted(unq,q,side='right')-1,len(unq)-2)
+            lower=unq[k]
+            upper=unq[k+1]
+        mid=((lower.astype(np.float64)+upper)/2).astype(col.dtype)
+        edges=np.unique(np.where(mid>lower,mid,upper))
+        X_binned[j]=np.searchsorted(edges,train_T[j],side='right')
+        bin_edges.append(edges)
+    return X_binned,bin_edges
 
-@jit
-def calculate_gain(original_loss,feature,g,h,threshold,reg_lambda):
+@njit('int64(int32[::1],int32[::1],int32[::1],int32[::1])',
+    fastmath=True,boundscheck=False,cache=True)
+def _select_rows(node_of_sample,build,rows,row_slot):
     '''
-    Given the original loss,
-    and the threshold to split,
-    calculate the new loss.
+    Collect the samples whose histograms are to be built into rows,
+    together with the histogram slot of each of them into row_slot, and return their number.
+    node_of_sample holds the id of the node each sample is at, or -1 once it has reached a leaf,
+    and build maps the id of a node to its histogram slot, or -1 if its histograms are not built.
+    Every sample is written at the end of rows, but only kept if selected,
+    so that the pass has no branch on whether a sample is selected.
     '''
-    left_g=0
-    left_h=0
-    right_g=0
-    right_h=0
-    for i in range(len(feature)):
-        if feature[i]<threshold:
-            left_g+=g[i]
-            left_h+=h[i]
-        else:
-            right_g+=g[i]
-            right_h+=h[i]
-    left_loss=-0.5*np.square(left_g)/(left_h+reg_lambda)
-    right_loss=-0.5*np.square(right_g)/(right_h+reg_lambda)
-    return original_loss-left_loss-right_loss
-
-@jit
-def find_threshold(g,h,train,reg_lambda):
-    '''
-    Given a particular feature,
-    return the best split threshold together with the gain that is achieved.
-    '''
-    loss=leaf_loss(g,h,reg_lambda)
-    threshold=None
-    best_gain=0
-    unq=np.unique(train)
-    for i in range(1,len(unq)):
-        this_threshold=(unq[i-1]+unq[i])/2
-        this_gain=calculate_gain(loss,train,g,h,this_threshold,reg_lambda)
+    n_rows=0
+    for i in range(len(node_of_sample)):
+        node=node_of_sample[i]
+        s=build[max(node,0)]
+        rows[n_rows]=i
+        row_slot[n_rows]=s
+        n_rows+=(node>=0)&(s>=0)
+    return n_rows
+
+@njit('void(uint8[:,::1],float32[::1],float32[::1],int32[::1],int32[::1],int32[::1],'
+    'float64[:,:,::1],float64[:,:,::1],int64[:,:,::1])',
+    parallel=True,fastmath=True,boundscheck=False,cache=True)
+def build_histograms(X_binned,g,h,rows,row_slot,slots,hist_g,hist_h,hist_n):
+    '''
+    Accumulate the gradient, hessian and number of samples into the histograms
+    of a batch of nodes, in a single pass over the samples in rows.
+    The histograms are indexed by (slot,feature,bin), and row_slot holds the histogram slot of each sample.
+    slots holds the slots of the nodes in the batch, which are zeroed first.
+    The features are scanned in parallel, so that no two threads write to the same histogram.
+    g and h are stored as float32, while the histograms are accumulated in float64.
+    '''
+    for f in prange(X_binned.shape[0]):
+        for s in slots:
+            hist_g[s,f,:]=0
+            hist_h[s,f,:]=0
+            hist_n[s,f,:]=0
+        feature=X_binned[f]
+        for k in range(len(rows)):
+            i=rows[k]
+            s=row_slot[k]
+            b=feature[i]
+            hist_g[s,f,b]+=g[i]
+            hist_h[s,f,b]+=h[i]
+            hist_n[s,f,b]+=1
+
+@njit('Tuple((int64,float64,float64,float64,int64))'
+    '(float64[::1],float64[::1],int64[::1],float64,float64,int64,int64,float64)',
+    fastmath=True,boundscheck=False,cache=True)
+def find_threshold(hist_g,hist_h,hist_n,G_tot,H_tot,n_tot,n_bins,reg_lambda):
+    '''
+    Given the histograms of a particular binned feature at a node,
+    and the sums of gradient, hessian and number of samples at this node,
+    return the best split bin together with the gain that is achieved,
+    and the sums of gradient, hessian and number of samples at the left child.
+    The histograms are swept from left to right,
+    so that the left and right sums of every candidate split are available in O(1).
+    Samples in bins lower than or equal to the split bin go to the left child.
+    '''
+    loss=-0.5*G_tot*G_tot/(H_tot+reg_lambda)
+    split_bin=0
+    best_gain=0.0
+    best_g=0.0
+    best_h=0.0
+    best_n=0
+    left_g=0.0
+    left_h=0.0
+    left_n=0
+    for b in range(n_bins-1):
+        left_g+=hist_g[b]
+        left_h+=hist_h[b]
+        left_n+=hist_n[b]
+        if left_n==0 or left_n==n_tot:
+            continue
+        right_g=G_tot-left_g
+        right_h=H_tot-left_h
+        left_loss=-0.5*left_g*left_g/(left_h+reg_lambda)
+        right_loss=-0.5*right_g*right_g/(right_h+reg_lambda)
+        this_gain=loss-left_loss-right_loss
         if this_gain>best_gain:
-            threshold=this_threshold
+            split_bin=b
             best_gain=this_gain
-    return threshold,best_gain
+            best_g=left_g
+            best_h=left_h
+            best_n=left_n
+    return split_bin,best_gain,best_g,best_h,best_n
 
-@jit
-def find_best_split(train,g,h,reg_lambda):
+@njit('Tuple((int64,int64,float64,float64,float64,int64))'
+    '(float64[:,::1],float64[:,::1],int64[:,::1],float64,float64,int64,int64[::1],float64)',
+    parallel=True,fastmath=True,boundscheck=False,cache=True)
+def find_best_split(hist_g,hist_h,hist_n,G,H,n,n_bins,reg_lambda):
     '''
-    Return the best feature to split together with the corresponding threshold.
-    Each feature is scanned by find_threshold(),
-    a (threshold,gain) tuple is returned for each feature.
+    Return the best feature to split together with the corresponding split bin.
+    hist_g, hist_h and hist_n are the histograms of a node, indexed by (feature,bin),
+    and G, H and n are the sums of gradient, hessian and number of samples at this node.
+    The features are scanned by find_threshold() in parallel,
+    a (split_bin,gain,G_left,H_left,n_left) tuple is returned for each feature.
     Then we select the feature with the largest best_gain,
-    and return index of that feature, the threshold, and the gain that is achieved.
-    '''
-    train=train.T
-    feature=0
-    threshold=None
-    best_gain=0
-    for i in range(len(train)):
-        this_threshold,this_gain=find_threshold(g,h,train[i],reg_lambda)
-        if this_gain>best_gain:
-            feature=i
-            threshold=this_threshold
-            best_gain=this_gain
-    return feature,threshold,best_gain
+    and return index of that feature, the split bin, the gain that is achieved,
+    and the sums of gradient, hessian and number of samples at the left child.
+    '''
+    n_features=hist_g.shape[0]
+    split_bins=np.zeros(n_features,dtype=np.int64)
+    gains=np.zeros(n_features)
+    G_left=np.zeros(n_features)
+    H_left=np.zeros(n_features)
+    n_left=np.zeros(n_features,dtype=np.int64)
+    for i in prange(n_features):
+        split_bins[i],gains[i],G_left[i],H_left[i],n_left[i]=find_threshold(
+            hist_g[i],hist_h[i],hist_n[i],G,H,n,n_bins[i],reg_lambda)
+    feature=gains.argmax()
+    return feature,split_bins[feature],gains[feature],G_left[feature],H_left[feature],n_left[feature]
+
+@njit('void(uint8[:,::1],int32[::1],int32[::1],int32[::1],int32[::1],int32[::1],boolean[::1])',
+    parallel=True,fastmath=True,boundscheck=False,cache=True)
+def _route(X_binned,node_of_sample,split_feature,split_bin,left_child,right_child,is_leaf):
+    '''
+    Move every sample from the node it is at to the child of that node,
+    or mark it with -1 if the node has become a leaf.
+    '''
+    for i in prange(len(node_of_sample)):
+        node=node_of_sample[i]
+        if node<0:
+            continue
+        if is_leaf[node]:
+            node_of_sample[i]=-1
+        else:
+            go_left=X_binned[split_feature[node],i]<=split_bin[node]
+            node_of_sample[i]=go_left*left_child[node]+(1-go_left)*right_child[node]
+
+@njit('int64(int64[::1],int64,int64,int64,float64,'
+    'float64[::1],float64[::1],int64[::1],boolean[::1],int32[::1],int32[::1],int32[::1],'
+    'float32[::1],int32[::1],int64[::1],int64[::1])',
+    fastmath=True,boundscheck=False,cache=True)
+def _plan_level(level,depth,max_depth,min_sample_split,reg_lambda,
+    node_G,node_H,node_n,grow,slot,parent,derive,
+    score,free_slots,n_free,to_build):
+    '''
+    Decide which nodes at a level are to be grown, and turn the others into leaves.
+    Then list the nodes whose histograms are to be built into to_build, and return their number.
+    slot maps the id of a node to the histogram slot holding its histograms, or -1.
+    If the histograms of the parent of a split were kept,
+    only the histograms of the smaller child are built,
+    and the larger child takes over the slot of the parent,
+    to derive its histograms there once those of its sibling are built,
+    which is recorded by derive mapping the smaller child to the larger one.
+    Otherwise the histograms of every child to be grown are built.
+    Slots that are no longer needed are pushed onto the free_slots stack, which holds n_free[0] slots.
+    '''
+    for node in level:
+        if depth<max_depth and node_n[node]>=min_sample_split:
+            grow[node]=True
+        else:
+            score[node]=leaf_score(node_G[node],node_H[node],reg_lambda)
+
+    n_build=0
+    if depth==0:
+        if grow[0]:
+            to_build[0]=0
+            n_build=1
+        return n_build
+
+    for k in range(0,len(level),2):
+        small=level[k]
+        large=level[k+1]
+        if node_n[small]>node_n[large]:
+            small,large=large,small
+        p=parent[small]
+        if slot[p]>=0 and grow[large]:
+            slot[large]=slot[p]
+            derive[small]=large
+            to_build[n_build]=small
+            n_build+=1
+        else:
+            if slot[p]>=0:
+                free_slots[n_free[0]]=slot[p]
+                n_free[0]+=1
+            if grow[small]:
+                to_build[n_build]=small
+                n_build+=1
+            if grow[large]:
+                to_build[n_build]=large
+                n_build+=1
+        slot[p]=-1
+    return n_build
+
+@njit('UniTuple(int64,2)(int64[::1],int64,int64,int32[::1],int64[::1],int32[::1],int32[::1],'
+    'int32[::1],int32[::1],int32[::1],int32[::1])',
+    fastmath=True,boundscheck=False,cache=True)
+def _plan_batch(to_build,start,n_build,free_slots,n_free,slot,build,slots,node_of_sample,rows,row_slot):
+    '''
+    Take as many nodes from to_build, from position start on, as there are free histogram slots,
+    and give each of them a slot, which is also written to slots.
+    Then collect the samples at these nodes into rows by _select_rows().
+    Return the end of the batch in to_build and the number of rows.
+    '''
+    end=min(n_build,start+n_free[0])
+    for k in range(start,end):
+        node=to_build[k]
+        n_free[0]-=1
+        slot[node]=free_slots[n_free[0]]
+        build[node]=slot[node]
+        slots[k-start]=slot[node]
+    return end,_select_rows(node_of_sample,build,rows,row_slot)
+
+@njit('void(int64[::1],int64,int64,int64,int64,int64,int64[::1],float64,float64,'
+    'float64[:,:,::1],float64[:,:,::1],int64[:,:,::1],'
+    'float64[::1],float64[::1],int64[::1],boolean[::1],int32[::1],int32[::1],int32[::1],'
+    'int32[::1],int32[::1],int32[::1],int32[::1],int32[::1],int64[::1],boolean,'
+    'boolean[::1],float32[::1],int32[::1],int64[::1],int64,int64[::1],int64[::1],int64[::1])',
+    fastmath=True,boundscheck=False,cache=True)
+def _split_batch(to_build,start,end,depth,max_depth,min_sample_split,n_bins,reg_lambda,gamma,
+    hist_g,hist_h,hist_n,node_G,node_H,node_n,grow,slot,build,derive,
+    split_feature,split_bin,left_child,right_child,parent,n_nodes,heap,
+    is_leaf,score,free_slots,n_free,max_keep,n_keep,next_level,n_next):
+    '''
+    Once the histograms of the batch to_build[start:end] have been built,
+    derive the histograms of the larger child of each split in place,
+    by subtracting those of the smaller child from those of the parent,
+    element by element so that no temporary array is allocated.
+    Then split each node to be grown on its own histograms,
+    and append the ids of its children to next_level, which holds n_next[0] ids.
+    The children of node k get ids 2k+1 and 2k+2 if heap is True,
+    otherwise the next two unused ids, and n_nodes is a length-1 array
+    holding the number of ids used so far.
+    The sums at the left child are returned by find_best_split(),
+    and the sums at the right child are derived by subtraction.
+    A node keeps its histograms for the next level only if its larger child is to be grown,
+    and at most max_keep nodes of a level keep them, counted by n_keep[0].
+    The slots of the other nodes are freed.
+    '''
+    for k in range(start,end):
+        small=to_build[k]
+        build[small]=-1
+        large=derive[small]
+        if large>=0:
+            s=slot[small]
+            l=slot[large]
+            for f in range(hist_g.shape[1]):
+                for b in range(hist_g.shape[2]):
+                    hist_g[l,f,b]-=hist_g[s,f,b]
+                    hist_h[l,f,b]-=hist_h[s,f,b]
+                    hist_n[l,f,b]-=hist_n[s,f,b]
+
+    for k in range(start,end):
+        small=to_build[k]
+        large=np.int64(derive[small])
+        derive[small]=-1
+        for node in (small,large):
+            if node<0:
+                continue
+            keep=False
+            if grow[node]:
+                s=slot[node]
+                feature,this_bin,gain,G_left,H_left,n_left=find_best_split(
+                    hist_g[s],hist_h[s],hist_n[s],node_G[node],node_H[node],node_n[node],n_bins,reg_lambda)
+                if gain<=gamma:
+                    score[node]=leaf_score(node_G[node],node_H[node],reg_lambda)
+                else:
+                    if heap:
+                        left=2*node+1
+                    else:
+                        left=n_nodes[0]
+                    right=left+1
+                    n_nodes[0]=max(n_nodes[0],right+1)
+                    is_leaf[node]=False
+                    split_feature[node]=feature
+                    split_bin[node]=this_bin
+                    left_child[node]=left
+                    right_child[node]=right
+                    parent[left]=node
+                    parent[right]=node
+                    node_G[left]=G_left
+                    node_H[left]=H_left
+                    node_n[left]=n_left
+                    node_G[right]=node_G[node]-G_left
+                    node_H[right]=node_H[node]-H_left
+                    node_n[right]=node_n[node]-n_left
+                    next_level[n_next[0]]=left
+                    next_level[n_next[0]+1]=right
+                    n_next[0]+=2
+                    keep=(depth+1<max_depth and max(node_n[left],node_n[right])>=min_sample_split
+                        and n_keep[0]<max_keep)
+            if keep:
+                n_keep[0]+=1
+            else:
+                free_slots[n_free[0]]=slot[node]
+                n_free[0]+=1
+                slot[node]=-1
+
+if cuda is not None:
+    @cuda.jit
+    def _build_histograms_cuda(X_binned,g,h,rows,row_slot,hist_g,hist_h,hist_n):
+        '''
+        The GPU counterpart of build_histograms(), with one thread per sample in rows,
+        each adding its gradient, hessian and count to the histograms of every feature
+        with atomic operations.
+        '''
+        k=cuda.grid(1)
+        if k<len(rows):
+            i=rows[k]
+            s=row_slot[k]
+            for f in range(X_binned.shape[0]):
+                b=X_binned[f,i]
+                cuda.atomic.add(hist_g,(s,f,b),g[i])
+                cuda.atomic.add(hist_h,(s,f,b),h[i])
+                cuda.atomic.add(hist_n,(s,f,b),1)
+
+    @cuda.jit
+    def _zero_slots_cuda(slots,hist_g,hist_h,hist_n):
+        '''
+        Set the histograms in the given slots to zero, with one thread per entry.
+        '''
+        k=cuda.grid(1)
+        n_bins=hist_g.shape[2]
+        size=hist_g.shape[1]*n_bins
+        if k<len(slots)*size:
+            s=slots[k//size]
+            f=(k%size)//n_bins
+            b=k%n_bins
+            hist_g[s,f,b]=0
+            hist_h[s,f,b]=0
+            hist_n[s,f,b]=0
+
+def _build_histograms_gpu(X_binned,g,h,rows,row_slot,slots,device_buffers,hist_g,hist_h,hist_n):
+    '''
+    Build the histograms of a batch of nodes on the GPU, where X_binned, g and h are device arrays,
+    and copy them back into their slots of hist_g, hist_h and hist_n,
+    which are small enough for the splits to be found on the CPU.
+    device_buffers holds the device buffers for rows and row_slot and the device histogram pool,
+    which are allocated once per tree.
+    The slots of the batch are zeroed on the GPU, and only the selected rows are sent to the GPU.
+    '''
+    rows_device,row_slot_device,d_hist_g,d_hist_h,d_hist_n=device_buffers
+    threads=256
+    slots_device=cuda.to_device(slots)
+    size=len(slots)*hist_g.shape[1]*hist_g.shape[2]
+    _zero_slots_cuda[(size+threads-1)//threads,threads](slots_device,d_hist_g,d_hist_h,d_hist_n)
+    n_rows=len(rows)
+    if n_rows>0:
+        rows_device=rows_device[:n_rows]
+        row_slot_device=row_slot_device[:n_rows]
+        rows_device.copy_to_device(rows)
+        row_slot_device.copy_to_device(row_slot)
+        _build_histograms_cuda[(n_rows+threads-1)//threads,threads](X_binned,g,h,rows_device,row_slot_device,
+            d_hist_g,d_hist_h,d_hist_n)
+    for s in slots:
+        d_hist_g[s].copy_to_host(hist_g[s])
+        d_hist_h[s].copy_to_host(hist_h[s])
+        d_hist_n[s].copy_to_host(hist_n[s])
+
+@njit('int64(float32[::1],int32[::1],float32[::1],int32[::1],int32[::1],boolean[::1],boolean)',
+    fastmath=True,boundscheck=False,cache=True)
+def _traverse(sample,split_feature,split_threshold,left_child,right_child,is_leaf,heap):
+    '''
+    Traverse a tree for a single sample point,
+    and return the id of the leaf it falls into.
+    Whether a sample point goes left is hard to predict for the CPU,
+    so the child is selected by arithmetic on the comparison instead of a branch.
+    If the tree is heap-indexed, the children of node k are 2k+1 and 2k+2,
+    so no child ids need to be loaded.
+    '''
+    node=0
+    while not is_leaf[node]:
+        go_left=sample[split_feature[node]]<split_threshold[node]
+        if heap:
+            node=2*node+2-go_left
+        else:
+            node=go_left*left_child[node]+(1-go_left)*right_child[node]
+    return node
+
+@njit('void(float32[:,::1],int32[::1],float32[::1],int32[::1],int32[::1],boolean[::1],boolean,'
+    'float32[::1],float32[::1])',
+    parallel=True,fastmath=True,boundscheck=False,cache=True)
+def _predict(test,split_feature,split_threshold,left_child,right_child,is_leaf,heap,score,out):
+    '''
+    Traverse a flattened tree for all the sample points in parallel,
+    and write the prediction (score) of each sample point into out.
+    '''
+    for i in prange(len(test)):
+        out[i]=score[_traverse(test[i],split_feature,split_threshold,left_child,right_child,is_leaf,heap)]
+
+@njit('void(float32[:,::1],int32[::1],float32[::1],int32[::1],int32[::1],boolean[::1],boolean,'
+    'float32[::1],float64,float32[::1])',
+    parallel=True,fastmath=True,boundscheck=False,cache=True)
+def _accumulate(test,split_feature,split_threshold,left_child,right_child,is_leaf,heap,score,learning_rate,out):
+    '''
+    Traverse a flattened tree for all the sample points in parallel,
+    and add the prediction (score) of each sample point times learning_rate to out in place,
+    so that no temporary array of predictions is allocated.
+    '''
+    for i in prange(len(test)):
+        out[i]+=learning_rate*score[
+            _traverse(test[i],split_feature,split_threshold,left_child,right_child,is_leaf,heap)]
+
+@njit('void(float32[::1],float32[::1],float32[::1],float32[::1])',
+    parallel=True,fastmath=True,boundscheck=False,cache=True)
+def _logloss_gh(true,score,g,h):
+    '''
+    Compute the gradient and hessian of log loss in a single pass,
+    evaluating the logistic transformation once per sample point,
+    and write them into g and h in place.
+    '''
+    for i in prange(len(score)):
+        pred=1/(1+np.exp(-score[i]))
+        g[i]=pred-true[i]
+        h[i]=pred*(1-pred)
 
 class loss(metaclass=ABCMeta):
     '''
@@ -89,6 +483,8 @@ class loss(metaclass=ABCMeta):
     link() is the link function, which takes scores as input, and returns predictions.
     g() is the gradient, which takes true values and scores as input, and returns gradient.
     h() is the heassian, which takes true values and scores as input, and returns hessian.
+    gh() writes both gradient and hessian into the given arrays in place.
+    By default it calls g() and h(), and a loss could override it to compute both in one pass.
     All inputs and outputs are numpy arrays.
     '''
     @abstractmethod
@@ -103,6 +499,10 @@ class loss(metaclass=ABCMeta):
     def h(self,true,score):
         pass
 
+    def gh(self,true,score,g,h):
+        g[:]=self.g(true,score)
+        h[:]=self.h(true,score)
+
 class mse(loss):
     '''Loss class for mse. As for mse, link function is pred=score.'''
     def link(self,score):
@@ -114,6 +514,10 @@ class mse(loss):
     def h(self,true,score):
         return np.ones_like(score)
 
+    def gh(self,true,score,g,h):
+        np.subtract(score,true,out=g)
+        h.fill(1)
+
 class log(loss):
     '''Loss class for log loss. As for log loss, link function is logistic transformation.'''
     def link(self,score):
@@ -127,6 +531,9 @@ class log(loss):
         pred=self.link(score)
         return pred*(1-pred)
 
+    def gh(self,true,score,g,h):
+        _logloss_gh(true,score,g,h)
+
 
     
     
@@ -134,7 +541,6 @@ class GBDT(object):
     '''
     Parameters:
     ----------
-    n_threads: The number of threads used for fitting and predicting.
     loss: Loss function for gradient boosting.
         'mse' for regression task and 'log' for classfication task.
         A child class of the loss class could be passed to implement customized loss.
@@ -144,11 +550,26 @@ class GBDT(object):
     gamma: The regularization coefficient for number of tree nodes, also know as gamma.
     learning_rate: The learning rate of gradient boosting.
     n_estimators: Number of trees.
+    max_bin: The maximum number of bins each feature is bucketed into, at most 256.
+        Split thresholds are only searched among the bin edges.
+    gpu_min_samples: The minimum number of samples to build the histograms on the GPU.
+        None never uses the GPU. Otherwise the histograms are built on the GPU
+        when numba.cuda finds a GPU and there are at least gpu_min_samples samples, e.g. 100000;
+        below that the transfers cost more than they save.
+    n_threads: The number of threads used for fitting and predicting, a positive integer.
+        None to use all the threads Numba is configured with,
+        and larger values are capped by that number.
+        As each tree depends on the previous ones, trees are built one by one,
+        and the threads are used inside each tree, by the parallel kernels.
+        Numba picks its TBB threading layer when TBB is installed.
+        Set n_threads=1 when fitting several models in parallel, e.g. with joblib,
+        to avoid oversubscription.
     '''
     def __init__(self,
         loss='mse',
         max_depth=3,min_sample_split=10,reg_lambda=1,gamma=0,
-        learning_rate=0.1,n_estimators=100):
+        learning_rate=0.1,n_estimators=100,max_bin=256,gpu_min_samples=None,
+        n_threads=None):
         self.loss=loss
         self.max_depth=max_depth
         self.min_sample_split=min_sample_split
@@ -156,57 +577,66 @@ class GBDT(object):
         self.gamma=gamma
         self.learning_rate=learning_rate
         self.n_estimators=n_estimators
+        self.max_bin=max_bin
+        self.gpu_min_samples=gpu_min_samples
+        self.n_threads=n_threads
+
+    @contextmanager
+    def _num_threads(self):
+        '''
+        Set the number of threads used by the parallel kernels in the calling thread
+        for the duration of a fit or predict call, and restore the previous number afterwards,
+        so that other parallel code run by the caller is not affected.
+        The number is capped by the number of threads Numba is configured with.
+        '''
+        n_threads=numba.config.NUMBA_NUM_THREADS
+        if self.n_threads is not None:
+            if not isinstance(self.n_threads,(int,np.integer)) or self.n_threads<1:
+                raise ValueError('n_threads should be a positive integer.')
+            n_threads=min(self.n_threads,n_threads)
+        previous=numba.get_num_threads()
+        numba.set_num_threads(n_threads)
+        try:
+            yield
+        finally:
+            numba.set_num_threads(previous)
 
     def fit(self,train,target):
-        self.estimators=[]
-        if self.loss=='mse':
-            self.loss=mse()
-        if self.loss=='log':
-            self.loss=log()
-        self.score_start=target.mean()
-        score=np.ones(len(train))*self.score_start
-        for i in range(self.n_estimators):
-            estimator=Tree(
-                max_depth=self.max_depth,min_sample_split=self.min_sample_split,reg_lambda=self.reg_lambda,gamma=self.gamma)
-            estimator.fit(train,g=self.loss.g(target,score),h=self.loss.h(target,score))
-            self.estimators.append(estimator)
-            score+=self.learning_rate*estimator.predict(train)
-        return self
+        with self._num_threads():
+            self.estimators=[]
+            if self.loss=='mse':
+                self.loss=mse()
+            if self.loss=='log':
+                self.loss=log()
+            train=np.ascontiguousarray(train,dtype=np.float32)
+            target=target.astype(np.float32)
+            self.score_start=target.mean()
+            score=np.full(len(train),self.score_start,dtype=np.float32)
+            X_binned,bin_edges=_bin_features(train,self.max_bin)
+            g=np.empty(len(train),dtype=np.float32)
+            h=np.empty(len(train),dtype=np.float32)
+            node_of_sample=np.empty(len(train),dtype=np.int32)
+            X_binned_device=None
+            if (self.gpu_min_samples is not None and len(train)>=self.gpu_min_samples
+                and cuda is not None and cuda.is_available()):
+                X_binned_device=cuda.to_device(X_binned)
+            for i in range(self.n_estimators):
+                estimator=Tree(
+                    max_depth=self.max_depth,min_sample_split=self.min_sample_split,reg_lambda=self.reg_lambda,gamma=self.gamma)
+                self.loss.gh(target,score,g,h)
+                estimator.fit(X_binned,bin_edges,g,h,node_of_sample,X_binned_device)
+                self.estimators.append(estimator)
+                estimator.accumulate(train,self.learning_rate,score)
+            return self
 
     def predict(self,test):
-        score=np.ones(len(test))*self.score_start
-        for i in range(self.n_estimators):
-            score+=self.learning_rate*self.estimators[i].predict(test)
-        return self.loss.link(score)
-
+        with self._num_threads():
+            test=np.ascontiguousarray(test,dtype=np.float32)
+            score=np.full(len(test),self.score_start,dtype=np.float32)
+            for i in range(self.n_estimators):
+                self.estimators[i].accumulate(test,self.learning_rate,score)
+            return self.loss.link(score)
 
-class TreeNode(object):
-    '''
-    The data structure that are used for storing trees.
-    A tree is presented by a set of nested TreeNodes,
-    with one TreeNode pointing two child TreeNodes,
-    until a tree leaf is reached.
-
-    Parameters:
-    ----------
-    is_leaf: If is TreeNode is a leaf.
-    score: The prediction (score) of a tree leaf.
-    split_feature: The split feature of a tree node.
-    split_threshold: The split threshold of a tree node.
-    left_child: Pointing to a child TreeNode,
-        where the value of split feature is less than the split threshold.
-    right_child: Pointing to a child TreeNode,
-        where the value of split features is greater than or equal to the split threshold.
-    '''
-    def __init__(self,
-        is_leaf=False,score=None,
-        split_feature=None,split_threshold=None,left_child=None,right_child=None):
-        self.is_leaf=is_leaf
-        self.score=score
-        self.split_feature=split_feature
-        self.split_threshold=split_threshold
-        self.left_child=left_child
-        self.right_child=right_child
 
 class Tree(object):
     '''
@@ -216,11 +646,28 @@ class Tree(object):
 
     Parameters:
     ----------
-    n_threads: The number of threads used for fitting and predicting.
     max_depth: The maximum depth of the tree.
     min_sample_split: The minimum number of samples required to further split a node.
     reg_lamda: The regularization coefficient for leaf prediction, also known as lambda.
-    gamma: The regularization coefficient for number of TreeNode, also know as gamma.
+    gamma: The regularization coefficient for number of tree nodes, also know as gamma.
+
+    Attributes:
+    ----------
+    The fitted tree is stored as flat arrays indexed by node id, the root having id 0.
+    If max_depth is at most _HEAP_MAX_DEPTH, the nodes are laid out as a binary heap,
+    where the children of node k have ids 2k+1 and 2k+2,
+    and ids not reached by the tree are marked as leaves and never visited.
+    Deeper trees would leave most of a heap unused,
+    so their nodes get compact ids in the order they are created.
+    heap: If the nodes are laid out as a binary heap.
+    is_leaf: If the node is a leaf.
+    score: The prediction (score) of a tree leaf.
+    split_feature: The split feature of a tree node.
+    split_threshold: The split threshold of a tree node.
+    left_child: The id of the child node,
+        where the value of split feature is less than the split threshold.
+    right_child: The id of the child node,
+        where the value of split features is greater than or equal to the split threshold.
     '''
     def __init__(self,max_depth=3,min_sample_split=10,reg_lambda=1,gamma=0):
         self.max_depth=max_depth
@@ -228,42 +675,68 @@ class Tree(object):
         self.reg_lambda=reg_lambda
         self.gamma=gamma
 
-    def fit(self,train,g,h):
+    def fit(self,X_binned,bin_edges,g,h,node_of_sample=None,X_binned_device=None):
         '''
         All inputs must be numpy arrays.
-        g and h are gradient and hessian respectively.
+        X_binned and bin_edges are the binned features and the bin edges returned by _bin_features().
+        g and h are gradient and hessian respectively, which are cast to float32.
+        node_of_sample is an int32 buffer with one entry per sample point used while growing the tree,
+        which could be passed to avoid allocating it for every tree.
+        X_binned_device is a copy of X_binned on the GPU, given to build the histograms on the GPU.
         '''
-        self.estimator=self.construct_tree(train,g,h,self.max_depth)
+        if self.max_depth<0:
+            raise ValueError('max_depth should be non-negative.')
+        g=np.ascontiguousarray(g,dtype=np.float32)
+        h=np.ascontiguousarray(h,dtype=np.float32)
+        n_bins=np.array([len(edges)+1 for edges in bin_edges],dtype=np.int64)
+        self.heap=self.max_depth<=_HEAP_MAX_DEPTH
+        max_nodes=2**(self.max_depth+1)-1
+        if not self.heap:
+            # A tree on n samples has at most 2n-1 nodes, and compact ids leave no gaps.
+            max_nodes=min(max_nodes,2*len(g)-1)
+        self.is_leaf=np.ones(max_nodes,dtype=np.bool_)
+        self.score=np.zeros(max_nodes,dtype=np.float32)
+        self.split_feature=np.zeros(max_nodes,dtype=np.int32)
+        self.left_child=np.zeros(max_nodes,dtype=np.int32)
+        self.right_child=np.zeros(max_nodes,dtype=np.int32)
+        split_bin=np.zeros(max_nodes,dtype=np.int32)
+        if node_of_sample is None:
+            node_of_sample=np.empty(len(g),dtype=np.int32)
+        n_nodes=self.construct_tree(X_binned,g,h,n_bins,split_bin,node_of_sample,X_binned_device)
+        self.is_leaf=self.is_leaf[:n_nodes].copy()
+        self.score=self.score[:n_nodes].copy()
+        self.split_feature=self.split_feature[:n_nodes].copy()
+        self.left_child=self.left_child[:n_nodes].copy()
+        self.right_child=self.right_child[:n_nodes].copy()
+        self.split_threshold=np.zeros(n_nodes,dtype=np.float32)
+        for k in np.flatnonzero(~self.is_leaf):
+            self.split_threshold[k]=bin_edges[self.split_feature[k]][split_bin[k]]
         return self
 
-    def predict(self,test):
-        '''
-        test must be numpy array.
-        Return predictions (scores) as an array.
-        Multiprocessing is supported for prediction.
+    def construct_tree(self,X_binned,g,h,n_bins,split_bin,node_of_sample,X_binned_device):
         '''
-        result=np.zeros(len(test))
-        for i in range(len(test)):
-            result[i]=self.predict_single(self.estimator,test[i])
-        return result
-
-    def predict_single(self,treenode,test):
-        '''
-        The predict method for a single sample point.
-        test must be numpy array.
-        Return prediction (score) as a number.
-        '''
-        if treenode.is_leaf:
-            return treenode.score
-        else:
-            if test[treenode.split_feature]<treenode.split_threshold:
-                return self.predict_single(treenode.left_child,test)
-            else:
-                return self.predict_single(treenode.right_child,test)
-
-    def construct_tree(self,train,g,h,max_depth):
-        '''
-        Construct tree recursively.
+        Construct tree level by level into flat arrays indexed by node id,
+        with the attributes of the node with id k stored at position k.
+        The root has id 0, and the ids of the children of a node are kept in left_child and right_child.
+        If self.heap is True, the children of node k have ids 2k+1 (left) and 2k+2 (right),
+        otherwise the ids are assigned in the order the nodes are created.
+        All the nodes at a level are grown together:
+        _plan_level() decides which nodes are to be grown and which histograms are to be built,
+        then the histograms are built in batches, each in a single pass over the samples,
+        by build_histograms() or on the GPU if X_binned_device is given,
+        and _split_batch() splits the nodes of the batch on their own histograms.
+        Finally _route() routes the samples to the next level.
+        Below the root, only the histograms of the smaller child of each split are built,
+        and those of the larger child are derived by subtracting them from the histograms of the parent,
+        which are kept until the children have been grown.
+        The histograms live in a pool of slots allocated once per tree,
+        whose size is bounded by _HIST_POOL_BYTES instead of growing with the number of nodes at a level.
+        A batch takes as many nodes as there are free slots,
+        and at most (n_pool-1)//2 nodes of a level keep their histograms for the next level,
+        so that the kept histograms of two consecutive levels always leave a free slot.
+        Past that, both children of a split are built directly.
+        node_of_sample is a buffer holding the id of the node each sample is at.
+        Return the number of ids used, past which the arrays hold no node.
         First we should check if we should stop further splitting.
         The stopping conditions include:
         1. We have reached the pre-determined max_depth
@@ -272,7 +745,8 @@ class Tree(object):
         4. Targets take only one value.
         5. Each feature takes only one value.
         By careful design, we could avoid checking condition 4 and 5 explicitly.
-        In function find_threshold(), the best_gain is set to 0 initially.
+        In function find_threshold(), the best_gain is set to 0 initially,
+        and only splits with samples on both sides are considered.
         So if there are no further feature to split,
         or all the targets take the same value,
         the return value of best_gain would be zero.
@@ -281,15 +755,92 @@ class Tree(object):
         To conclude, we need only to check condition 1,2 and 3.
         '''
 
-        if max_depth==0 or len(train)<self.min_sample_split:
-            return TreeNode(is_leaf=True,score=leaf_score(g,h,self.reg_lambda))
+        max_nodes=len(self.is_leaf)
+        n_features=len(X_binned)
+        max_bin=n_bins.max()
+        node_G=np.zeros(max_nodes)
+        node_H=np.zeros(max_nodes)
+        node_n=np.zeros(max_nodes,dtype=np.int64)
+        node_G[0]=g.sum(dtype=np.float64)
+        node_H[0]=h.sum(dtype=np.float64)
+        node_n[0]=len(g)
+        node_of_sample[:]=0
+        parent=np.zeros(max_nodes,dtype=np.int32)
+        n_nodes=np.ones(1,dtype=np.int64)
+        grow=np.zeros(max_nodes,dtype=np.bool_)
+        slot=np.full(max_nodes,-1,dtype=np.int32)
+        build=np.full(max_nodes,-1,dtype=np.int32)
+        rows=np.empty(len(g),dtype=np.int32)
+        row_slot=np.empty(len(g),dtype=np.int32)
+        derive=np.full(max_nodes,-1,dtype=np.int32)
+        n_pool=max(1,min(_HIST_POOL_BYTES//(24*n_features*max_bin),max_nodes))
+        max_keep=(n_pool-1)//2
+        hist_g=np.empty((n_pool,n_features,max_bin))
+        hist_h=np.empty((n_pool,n_features,max_bin))
+        hist_n=np.empty((n_pool,n_features,max_bin),dtype=np.int64)
+        free_slots=np.arange(n_pool,dtype=np.int32)
+        n_free=np.array([n_pool],dtype=np.int64)
+        slots=np.empty(n_pool,dtype=np.int32)
+        n_keep=np.zeros(1,dtype=np.int64)
+        n_next=np.zeros(1,dtype=np.int64)
+        if X_binned_device is not None:
+            g_device=cuda.to_device(g)
+            h_device=cuda.to_device(h)
+            device_buffers=(cuda.device_array(len(g),dtype=np.int32),cuda.device_array(len(g),dtype=np.int32),
+                cuda.device_array(hist_g.shape),cuda.device_array(hist_h.shape),
+                cuda.device_array(hist_n.shape,dtype=np.int64))
+        level=np.zeros(1,dtype=np.int64)
 
-        feature,threshold,gain=find_best_split(train,g,h,self.reg_lambda)
+        for depth in range(self.max_depth+1):
+            to_build=np.empty(len(level),dtype=np.int64)
+            n_build=_plan_level(level,depth,self.max_depth,self.min_sample_split,self.reg_lambda,
+                node_G,node_H,node_n,grow,slot,parent,derive,
+                self.score,free_slots,n_free,to_build)
+            if n_build==0:
+                break
 
-        if gain<=self.gamma:
-            return TreeNode(is_leaf=True,score=leaf_score(g,h,self.reg_lambda))
+            next_level=np.empty(2*len(level),dtype=np.int64)
+            n_next[0]=0
+            n_keep[0]=0
+            start=0
+            while start<n_build:
+                end,n_rows=_plan_batch(to_build,start,n_build,free_slots,n_free,slot,build,slots,
+                    node_of_sample,rows,row_slot)
+                if X_binned_device is None:
+                    build_histograms(X_binned,g,h,rows[:n_rows],row_slot[:n_rows],slots[:end-start],
+                        hist_g,hist_h,hist_n)
+                else:
+                    _build_histograms_gpu(X_binned_device,g_device,h_device,rows[:n_rows],row_slot[:n_rows],
+                        slots[:end-start],device_buffers,hist_g,hist_h,hist_n)
+                _split_batch(to_build,start,end,depth,self.max_depth,self.min_sample_split,
+                    n_bins,self.reg_lambda,self.gamma,
+                    hist_g,hist_h,hist_n,node_G,node_H,node_n,grow,slot,build,derive,
+                    self.split_feature,split_bin,self.left_child,self.right_child,parent,n_nodes,self.heap,
+                    self.is_leaf,self.score,free_slots,n_free,max_keep,n_keep,next_level,n_next)
+                start=end
+
+            _route(X_binned,node_of_sample,self.split_feature,split_bin,self.left_child,self.right_child,
+                self.is_leaf)
+            level=next_level[:n_next[0]]
+        return n_nodes[0]
+
+    def predict(self,test):
+        '''
+        test must be numpy array.
+        Return predictions (scores) as a float32 array.
+        All the sample points are traversed in parallel by compiled code.
+        '''
+        test=np.ascontiguousarray(test,dtype=np.float32)
+        result=np.empty(len(test),dtype=np.float32)
+        _predict(test,self.split_feature,self.split_threshold,self.left_child,self.right_child,
+            self.is_leaf,self.heap,self.score,result)
+        return result
 
-        index=train[:,feature]<threshold
-        left_child=self.construct_tree(train[index],g[index],h[index],max_depth-1)
-        right_child=self.construct_tree(train[~index],g[~index],h[~index],max_depth-1)
-        return TreeNode(split_feature=feature,split_threshold=threshold,left_child=left_child,right_child=right_child)
+    def accumulate(self,test,learning_rate,out):
+        '''
+        test must be numpy array, and out must be a float32 array.
+        Add the predictions (scores) times learning_rate to out in place.
+        '''
+        test=np.ascontiguousarray(test,dtype=np.float32)
+        _accumulate(test,self.split_feature,self.split_threshold,self.left_child,self.right_child,
+            self.is_leaf,self.heap,self.score,learning_rate,out)